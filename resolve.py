@@ -3,18 +3,52 @@ resolve.py: a recursive resolver built using dnspython
 """
 
 import argparse
+import asyncio
+import atexit
+import collections
+import ctypes
+import functools
+import json
+import os
+import pickle
+import random
+import socket
+import sys
+import time
 
+import dns.asyncquery
+import dns.flags
 import dns.message
 import dns.name
-import dns.query
+import dns.rcode
 import dns.rdata
-import dns.rdataclass
 import dns.rdatatype
+import dns.rrset
 
-FORMATS = (("CNAME", "{alias} is an alias for {name}"),
-           ("A", "{name} has address {address}"),
-           ("AAAA", "{name} has IPv6 address {address}"),
-           ("MX", "{name} mail is handled by {preference} {exchange}"))
+def _fmt_cname(result):
+    return f"{result['alias']} is an alias for {result['name']}"
+
+
+def _fmt_a(result):
+    return f"{result['name']} has address {result['address']}"
+
+
+def _fmt_aaaa(result):
+    return f"{result['name']} has IPv6 address {result['address']}"
+
+
+def _fmt_mx(result):
+    return (f"{result['name']} mail is handled by "
+            f"{result['preference']} {result['exchange']}")
+
+
+# Output lines as the host program prints them, one formatter per record
+# type; f-string functions compile to straight bytecode, with no format
+# parser or kwargs expansion left on the print path.
+FORMATS = (("CNAME", _fmt_cname),
+           ("A", _fmt_a),
+           ("AAAA", _fmt_aaaa),
+           ("MX", _fmt_mx))
 
 # current as of 25 October 2018
 ROOT_SERVERS = ("198.41.0.4",
@@ -31,225 +65,1039 @@ ROOT_SERVERS = ("198.41.0.4",
                 "199.7.83.42",
                 "202.12.27.33")
 
-_LAST_NAMESERVERS = list(ROOT_SERVERS)
+# Root servers reordered fastest-first by the background probe below; until
+# (and unless) the probe finishes, the hard-coded order is used as-is.
+_ROOT_ORDER = ROOT_SERVERS
+_ROOT_PROBE_STARTED = False
+ROOT_ORDER_REFRESH = 300
+_ROOT_ORDER_FILE = os.path.join(os.path.expanduser("~"), ".cache",
+                                "resolve_roots.json")
 
 def collect_results(name: str) -> dict:
+    """
+    Synchronous entry point for `_collect_results`, kept for callers that are
+    not running an event loop of their own.
+    """
+    return asyncio.run(_collect_results(name))
+
+
+def _handle_cname(answer, rrset_name, buckets, alias):
+    buckets["CNAME"].append({"name": answer, "alias": alias})
+    return answer
+
+
+def _handle_a(answer, rrset_name, buckets, alias):
+    buckets["A"].append({"name": rrset_name, "address": answer.address})
+    return alias
+
+
+def _handle_aaaa(answer, rrset_name, buckets, alias):
+    buckets["AAAA"].append({"name": rrset_name, "address": answer.address})
+    return alias
+
+
+def _handle_mx(answer, rrset_name, buckets, alias):
+    buckets["MX"].append({"name": rrset_name,
+                          "preference": answer.preference,
+                          "exchange": str(answer.exchange)})
+    return alias
+
+
+# Jump table from rdtype to record handler: one dict probe per record
+# instead of walking an if/elif chain, and trivially extensible should more
+# record types ever need printing. Each handler returns the (possibly
+# updated) tail of the alias chain.
+_HANDLERS = {dns.rdatatype.CNAME: _handle_cname,
+             dns.rdatatype.A: _handle_a,
+             dns.rdatatype.AAAA: _handle_aaaa,
+             dns.rdatatype.MX: _handle_mx}
+
+
+def _classify(response: dns.message.Message, buckets: dict, seen: set,
+              alias: str) -> str:
+    """
+    Walk a response's answer section once, dispatching each record into the
+    right bucket by rdtype. Records already seen (the CNAME-merged answers
+    repeat the A/AAAA sets of the chain target) are skipped. Returns the
+    updated tail of the alias chain.
+    """
+    # Bind the loop invariants to locals: global/attribute lookups inside
+    # these nested loops are the bulk of their interpreted cost.
+    handler_for = _HANDLERS.get
+    seen_add = seen.add
+    for rrset in response.answer:
+        rrset_name = rrset.name
+        for answer in rrset:
+            handler = handler_for(answer.rdtype)
+            if handler is None:
+                continue
+            # Rdata objects are immutable and hash/compare by value, so
+            # the record itself keys the dedup — no to_text() rendering.
+            dedup_key = (rrset_name, answer.rdtype, answer)
+            if dedup_key in seen:
+                continue
+            seen_add(dedup_key)
+            alias = handler(answer, rrset_name, buckets, alias)
+    return alias
+
+
+async def _collect_results(name: str) -> dict:
     """
     This function parses final answers into the proper data structure that
-    print_results requires. The main work is done within the `lookup` function.
-    """
-    full_response = {}
-    target_name = dns.name.from_text(name)
-    # lookup CNAME
-    response = lookup(target_name, dns.rdatatype.CNAME)
-    cnames = []
-    tmp = name
-    for answers in response.answer:
-        for answer in answers:
-            cnames.append({"name": answer, "alias": tmp})
-            tmp = answer
-    # lookup A
-    response = lookup(target_name, dns.rdatatype.A)
-    arecords = []
-    for answers in response.answer:
-        a_name = answers.name
-        for answer in answers:
-            if answer.rdtype == 1:  # A record
-                arecords.append({"name": a_name, "address": str(answer)})
-    # lookup AAAA
-    response = lookup(target_name, dns.rdatatype.AAAA)
-    aaaarecords = []
-    for answers in response.answer:
-        aaaa_name = answers.name
-        for answer in answers:
-            if answer.rdtype == 28:  # AAAA record
-                aaaarecords.append({"name": aaaa_name, "address": str(answer)})
-    # lookup MX
-    response = lookup(target_name, dns.rdatatype.MX)
-    mxrecords = []
-    for answers in response.answer:
-        mx_name = answers.name
-        for answer in answers:
-            if answer.rdtype == 15:  # MX record
-                mxrecords.append({"name": mx_name,
-                                  "preference": answer.preference,
-                                  "exchange": str(answer.exchange)})
-
-    full_response["CNAME"] = cnames
-    full_response["A"] = arecords
-    full_response["AAAA"] = aaaarecords
-    full_response["MX"] = mxrecords
-
-    return full_response
-
-
-# Global cache (simple dict)
-CACHE = {}
+    print_results requires. The main work is done within the `_lookup`
+    function; the four record-type queries are independent, so they run
+    concurrently rather than paying four round-trips back to back, and each
+    returned message is classified in a single pass (one CNAME-merged
+    answer often already covers the A/AAAA sets, so the shared `seen` set
+    keeps the overlap from being parsed into duplicates).
+    """
+    buckets = {"CNAME": [], "A": [], "AAAA": [], "MX": []}
+    try:
+        target_name = _from_text(name)
+    except Exception:
+        # An unparseable name prints nothing rather than a traceback.
+        return buckets
+    responses = await asyncio.gather(_lookup(target_name, dns.rdatatype.CNAME),
+                                     _lookup(target_name, dns.rdatatype.A),
+                                     _lookup(target_name, dns.rdatatype.AAAA),
+                                     _lookup(target_name, dns.rdatatype.MX),
+                                     return_exceptions=True)
+    seen = set()
+    alias = name
+    for response in responses:
+        if isinstance(response, BaseException):
+            continue
+        alias = _classify(response, buckets, seen, alias)
+    return buckets
+
+
+class TTLCache:
+    """
+    Bounded mapping of (name, qtype) -> response. Entries expire with the
+    TTL they were stored under, and once `maxsize` distinct keys are held
+    the least recently used entry is evicted, so a batch run over many
+    unique names keeps memory (and dict-resize pauses) constant.
+
+    An expired entry lingers for `grace` further seconds: `get` no longer
+    serves it, but `peek` will, flagged stale, so the lookup front can
+    answer immediately and refresh in the background.
+    """
+
+    def __init__(self, maxsize: int = 10000, grace: float = 300):
+        self.maxsize = maxsize
+        self.grace = grace
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        response, fresh = self.peek(key)
+        return response if fresh else None
+
+    def peek(self, key):
+        """
+        Return (response, fresh). A stale-but-in-grace response comes back
+        with fresh=False; past the grace window the entry is dropped and
+        (None, False) is returned.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None, False
+        deadline, response = entry
+        now = time.monotonic()
+        if now < deadline:
+            self._entries.move_to_end(key)
+            return response, True
+        if now < deadline + self.grace:
+            return response, False
+        del self._entries[key]
+        return None, False
+
+    def set(self, key, response, ttl: float) -> None:
+        entries = self._entries
+        if key in entries:
+            del entries[key]
+        elif len(entries) >= self.maxsize:
+            entries.popitem(last=False)
+        entries[key] = (time.monotonic() + ttl, response)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+# Global response cache; expiry comes first, LRU handles overflow.
+CACHE = TTLCache()
+
+# Where the CLI saves still-fresh cache entries between invocations, so a
+# rerun goes straight to the servers it learned about last time instead of
+# repeating the root and TLD hops.
+CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache",
+                          "resolve_cache.pickle")
+
+# TTL (in seconds) used when a response carries no records to take a TTL
+# from, and the shorter TTL used to remember empty/negative answers.
+DEFAULT_TTL = 60
+NEGATIVE_TTL = 30
+
+# Clamp applied to record-derived lifetimes: nothing is trusted for more
+# than an hour (stale NS/glue past that is worse than a re-fetch), and
+# pathologically tiny TTLs get a 60s floor so hot names aren't re-walked
+# every few seconds.
+MIN_TTL = 60
+MAX_TTL = 3600
+
+# Pseudo-qtype under which an authoritative NXDOMAIN is cached for the
+# denied name. Per RFC 8020 the denial covers the whole subtree, so a
+# lookup first checks the name and each ancestor for a fresh marker.
+_NXDOMAIN = "NXDOMAIN"
+
+# Penalty box for unresponsive server IPs: maps ip -> monotonic expiry.
+# While an entry is fresh the server is skipped entirely, so one dead
+# root/TLD server cannot charge its timeout to every subsequent lookup.
+DEAD_NS = {}
+DEAD_NS_TTL = 30
+
+# Smoothed round-trip estimate per server IP, used to fail fast on servers
+# we have already measured instead of always waiting the full 3 seconds.
+RTT = {}
+MIN_TIMEOUT = 0.2
+MAX_TIMEOUT = 3.0
+
+# A TC-triggered TCP retry pays connection setup on top of the query, so
+# it gets a little more room than the UDP budget.
+TCP_TIMEOUT = 5.0
+
+# How many candidate servers one referral step queries concurrently. The
+# winner is whoever answers first; querying every candidate (13 roots x 4
+# record types) wastes bandwidth for no extra latency win, so each batch
+# takes the k with the best smoothed RTT and the rest stay in reserve.
+# One batch slot occasionally goes to a random straggler instead, so a
+# server whose estimate went bad can win its way back to the front.
+FANOUT = 3
+EXPLORE_CHANCE = 0.1
+
+# EDNS(0) advertised UDP payload. TLD referrals carrying 13 NS records plus
+# glue routinely blow the classic 512-byte limit; advertising 1232 bytes
+# (the flag-day recommendation) avoids the truncate-and-retry-over-TCP hop.
+EDNS_PAYLOAD = 1232
+
+# Bounds on recursive resolution work: how long a CNAME/alias chain we will
+# follow before giving up, and how deep nameserver-of-nameserver resolution
+# (unglued NS needing its own walk) may nest. Both exist so adversarial
+# zones can neither blow the Python stack nor keep us resolving forever:
+# chain-following spawns one sub-lookup per hop (plus the A/AAAA pair at
+# the entry hop only), nests at most MAX_RECURSION_DEPTH awaits -- a
+# handful of interpreter frames each, far under the default recursion
+# limit -- and the visited set cuts cycles off before they can even spend
+# that budget.
+MAX_RECURSION_DEPTH = 16
+MAX_NS_DEPTH = 8
+
+
+@functools.lru_cache(maxsize=4096)
+def _from_text(text: str) -> dns.name.Name:
+    """
+    Memoized dns.name.from_text: the same NS host names come back on every
+    referral during a walk, and Name objects are immutable, so parsing each
+    distinct string once is safe and skips dnspython's label validation on
+    repeats.
+    """
+    return dns.name.from_text(text)
+
+
+def cache_store(name: dns.name.Name, qtype_val, response, ttl=None) -> None:
+    """
+    Remember `response` for (name, qtype) until the shortest TTL across its
+    answer, authority and additional records runs out, clamped to
+    [MIN_TTL, MAX_TTL]. An explicit `ttl` skips the floor (negative
+    answers are deliberately short-lived) but still honors the cap.
+
+    Keys hold the Name object itself: it is immutable, caches its own
+    hash, and compares case-insensitively, so this is both cheaper and
+    more correct than converting to text for every cache touch.
+    """
+    if ttl is None:
+        ttl = min((rrset.ttl
+                   for section in (getattr(response, "answer", ()),
+                                   getattr(response, "authority", ()),
+                                   getattr(response, "additional", ()))
+                   for rrset in section),
+                  default=DEFAULT_TTL)
+        ttl = max(ttl, MIN_TTL)
+    CACHE.set((name, qtype_val), response, min(ttl, MAX_TTL))
+
+
+def _persist_cache() -> None:
+    """
+    Save the still-fresh cache entries for the next CLI run. Deadlines are
+    rebased from the monotonic clock onto wall time (monotonic readings
+    mean nothing in another process), responses are stored in wire form
+    (Message objects don't pickle), and the file is written to a unique
+    temp name and os.replace()d so concurrent runs can't corrupt it.
+    """
+    now_mono = time.monotonic()
+    now_wall = time.time()
+    entries = {}
+    for key, (deadline, response) in CACHE._entries.items():
+        remaining = deadline - now_mono
+        if remaining <= 0 or not isinstance(response, dns.message.Message):
+            continue
+        try:
+            entries[key] = (now_wall + remaining, response.to_wire())
+        except Exception:
+            continue
+    if not entries:
+        return
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (CACHE_FILE, os.getpid())
+        with open(tmp_path, "wb") as cache_file:
+            pickle.dump(entries, cache_file)
+        os.replace(tmp_path, CACHE_FILE)
+    except OSError:
+        pass
+
+
+def _load_cache() -> None:
+    """
+    Restore cache entries persisted by a previous run, skipping anything
+    whose wall-clock deadline has passed or whose wire form no longer
+    parses.
+    """
+    try:
+        with open(CACHE_FILE, "rb") as cache_file:
+            entries = pickle.load(cache_file)
+    except (OSError, pickle.PickleError, EOFError):
+        return
+    now_wall = time.time()
+    for key, (expires, wire) in entries.items():
+        ttl = expires - now_wall
+        if ttl <= 0:
+            continue
+        try:
+            CACHE.set(key, dns.message.from_wire(wire), ttl)
+        except Exception:
+            continue
+
+
+def cached_lookup(name: dns.name.Name, qtype_val):
+    """
+    Return the cached response for (name, qtype), or None if there is no
+    entry or the entry's TTL deadline has passed (expired entries are
+    dropped so the cache stays bounded).
+    """
+    return CACHE.get((name, qtype_val))
+
+
+# One server per popular TLD, taken from the IANA gTLD data the same way
+# ROOT_SERVERS was; refresh these alongside it. Seeding them as cached
+# delegations lets the deepest-delegation walker skip the root hop for a
+# cold two-label lookup; a stale entry just fails its batch and the walk
+# restarts from the roots as usual.
+_TLD_SEEDS = (("com.", "a.gtld-servers.net.", "192.5.6.30"),
+              ("net.", "a.gtld-servers.net.", "192.5.6.30"),
+              ("org.", "a0.org.afilias-nst.info.", "199.19.56.1"),
+              ("io.", "a0.nic.io.", "65.22.160.17"))
+
+
+def _seed_tld_hints() -> None:
+    """
+    Pre-warm the cache with referral-shaped entries for _TLD_SEEDS, built
+    in memory at import (no network, no files).
+    """
+    for zone_text, ns_text, ip in _TLD_SEEDS:
+        zone = _from_text(zone_text)
+        ns_name = _from_text(ns_text)
+        referral = dns.message.make_response(
+            dns.message.make_query(zone, dns.rdatatype.NS))
+        referral.authority.append(
+            dns.rrset.from_text(zone_text, MAX_TTL, "IN", "NS", ns_text))
+        cache_store(zone, dns.rdatatype.NS, referral, ttl=MAX_TTL)
+        glue = dns.message.make_response(
+            dns.message.make_query(ns_name, dns.rdatatype.A))
+        glue.answer.append(
+            dns.rrset.from_text(ns_text, MAX_TTL, "IN", "A", ip))
+        cache_store(ns_name, dns.rdatatype.A, glue, ttl=MAX_TTL)
+
+
+_seed_tld_hints()
+
+
+# sendmmsg(2) lets the fan-out hand all of a level's datagrams to the kernel
+# in one syscall instead of one sendto per server. Linux-only; anywhere the
+# binding is unavailable the client quietly falls back to per-packet sends.
+_LIBC = None
+if sys.platform.startswith("linux"):
+    try:
+        _LIBC = ctypes.CDLL(None, use_errno=True)
+        _LIBC.sendmmsg
+    except (OSError, AttributeError):
+        _LIBC = None
+
+
+class _Iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _SockaddrIn(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort),
+                ("sin_port", ctypes.c_uint16),
+                ("sin_addr", ctypes.c_uint32),
+                ("sin_zero", ctypes.c_char * 8)]
+
+
+class _Msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint),
+                ("msg_iov", ctypes.POINTER(_Iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _Mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _Msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+class _UdpClient(asyncio.DatagramProtocol):
+    """
+    One unconnected UDP socket shared by every in-flight query on the event
+    loop. Replies are matched to their waiters by (transaction id, server
+    ip), so a full root-to-authoritative walk costs one socket instead of a
+    socket()/bind()/close() round per hop.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+        self._loop = None
+        self._outbox = []
+        self._flush_scheduled = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 2:
+            return
+        key = ((data[0] << 8) | data[1], addr[0])
+        entry = self.pending.get(key)
+        if entry is None:
+            return
+        future, question = entry
+        # Validate before consuming the waiter (RFC 5452): a datagram that
+        # matches on id and source ip but is not a response to our question
+        # is ignored outright — the timeout keeps running and the genuine
+        # reply can still win — rather than poisoning the query.
+        try:
+            response = dns.message.from_wire(data)
+        except Exception:
+            return
+        if not (response.flags & dns.flags.QR) or response.question != question:
+            return
+        self.pending.pop(key, None)
+        if not future.done():
+            future.set_result(response)
+
+    def error_received(self, exc):
+        pass
+
+    async def query(self, query: dns.message.Message, ip: str,
+                    timeout: float) -> dns.message.Message:
+        wire = bytearray(query.to_wire())
+        # Every send gets a fresh transaction id, written into the wire
+        # copy rather than by mutating (and re-encoding) the shared message:
+        # reusing one id for a whole walk would let anyone who saw a single
+        # query forge every subsequent hop.
+        qid = random.getrandbits(16)
+        while (qid, ip) in self.pending:
+            qid = random.getrandbits(16)
+        wire[0] = qid >> 8
+        wire[1] = qid & 0xFF
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending[(qid, ip)] = (future, query.question)
+        try:
+            # Queue the datagram; everything queued within this loop tick
+            # (the whole per-level fan-out) is flushed in one batch.
+            self._outbox.append((bytes(wire), (ip, 53)))
+            if not self._flush_scheduled:
+                self._flush_scheduled = True
+                loop.call_soon(self._flush)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop((qid, ip), None)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        batch, self._outbox = self._outbox, []
+        if len(batch) > 1 and _LIBC is not None:
+            sent = self._sendmmsg(batch)
+            if sent:
+                batch = batch[sent:]
+        for wire, addr in batch:
+            self.transport.sendto(wire, addr)
+
+    def _sendmmsg(self, batch) -> int:
+        """
+        Hand `batch` ([(wire, (ip, port)), ...]) to the kernel in a single
+        sendmmsg call. Returns how many datagrams were accepted; 0 means
+        the caller should fall back to individual sends.
+        """
+        sock = self.transport.get_extra_info("socket")
+        if sock is None:
+            return 0
+        try:
+            count = len(batch)
+            addrs = (_SockaddrIn * count)()
+            iovecs = (_Iovec * count)()
+            msgs = (_Mmsghdr * count)()
+            buffers = []
+            for i, (wire, (ip, port)) in enumerate(batch):
+                buf = ctypes.create_string_buffer(wire, len(wire))
+                buffers.append(buf)
+                addrs[i].sin_family = socket.AF_INET
+                addrs[i].sin_port = socket.htons(port)
+                addrs[i].sin_addr = int.from_bytes(socket.inet_aton(ip),
+                                                   sys.byteorder)
+                iovecs[i].iov_base = ctypes.cast(buf, ctypes.c_void_p)
+                iovecs[i].iov_len = len(wire)
+                msgs[i].msg_hdr.msg_name = ctypes.cast(
+                    ctypes.byref(addrs[i]), ctypes.c_void_p)
+                msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(_SockaddrIn)
+                msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+                msgs[i].msg_hdr.msg_iovlen = 1
+            sent = _LIBC.sendmmsg(sock.fileno(), msgs, count, 0)
+            return max(sent, 0)
+        except Exception:
+            return 0
+
+
+_UDP_CLIENT = None
+
+
+async def _get_udp_client() -> _UdpClient:
+    """
+    Return the shared UDP client for the running event loop, creating it on
+    first use (and again after a previous loop, e.g. from an earlier
+    asyncio.run, has gone away).
+    """
+    global _UDP_CLIENT
+    loop = asyncio.get_running_loop()
+    if _UDP_CLIENT is not None and _UDP_CLIENT._loop is loop:
+        return _UDP_CLIENT
+    stale = _UDP_CLIENT
+    transport, client = await loop.create_datagram_endpoint(
+        _UdpClient, local_addr=("0.0.0.0", 0), family=socket.AF_INET)
+    if _UDP_CLIENT is not None and _UDP_CLIENT._loop is loop:
+        # Another task finished creating the client while we awaited; use
+        # theirs and drop ours so concurrent first users share one socket.
+        transport.close()
+        return _UDP_CLIENT
+    if stale is not None and stale.transport is not None:
+        try:
+            stale.transport.close()
+        except Exception:
+            pass
+    client._loop = loop
+    _UDP_CLIENT = client
+    return _UDP_CLIENT
+
+
+async def _send_query(query: dns.message.Message, ip: str,
+                      timeout: float = MAX_TIMEOUT) -> dns.message.Message:
+    """
+    Send one UDP query to one server; failures propagate to the caller.
+    Servers with a measured round-trip estimate get a proportionally
+    shorter timeout (4x their smoothed RTT, clamped to [0.2s, 3s]); an
+    unmeasured server keeps the full 3 seconds.
+    """
+    ewma = RTT.get(ip)
+    if ewma is not None:
+        timeout = min(timeout, max(MIN_TIMEOUT, 4 * ewma))
+    client = await _get_udp_client()
+    start = time.monotonic()
+    response = await client.query(query, ip, timeout)
+    elapsed = time.monotonic() - start
+    RTT[ip] = 0.8 * RTT.get(ip, elapsed) + 0.2 * elapsed
+    if response.flags & dns.flags.TC:
+        # Answer didn't fit even in the EDNS payload; redo over TCP.
+        response = await dns.asyncquery.tcp(query, ip, timeout=TCP_TIMEOUT)
+    return response
+
+
+async def _query_first(query: dns.message.Message, servers,
+                       timeout: float = 3):
+    """
+    Fire `query` at each of the given servers concurrently and return
+    (ip, response) for the first one that answers, cancelling the slower
+    attempts. Returns None when every server fails or times out, so one
+    dead server costs nothing as long as any of its siblings is alive.
+    """
+    tasks = {asyncio.ensure_future(_send_query(query, ip, timeout)): ip
+             for ip in servers}
+    pending = set(tasks)
+    winner = None
+    while pending and winner is None:
+        done, pending = await asyncio.wait(
+            pending, return_when=asyncio.FIRST_COMPLETED)
+        # Retrieve every completed result (not just the winner's) so failed
+        # tasks are boxed and never warn about unretrieved exceptions.
+        for task in done:
+            try:
+                response = task.result()
+            except Exception:
+                DEAD_NS[tasks[task]] = time.monotonic() + DEAD_NS_TTL
+                continue
+            if winner is None:
+                winner = (tasks[task], response)
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+    return winner
+
+
+def _load_root_order() -> bool:
+    """
+    Reuse the root ordering persisted by a recent previous run, so short
+    CLI invocations don't re-probe all thirteen roots each start.
+    """
+    try:
+        if time.time() - os.path.getmtime(_ROOT_ORDER_FILE) < ROOT_ORDER_REFRESH:
+            with open(_ROOT_ORDER_FILE) as order_file:
+                order = json.load(order_file)
+            if sorted(order) == sorted(ROOT_SERVERS):
+                global _ROOT_ORDER
+                _ROOT_ORDER = tuple(order)
+                return True
+    except (OSError, ValueError):
+        pass
+    return False
+
+
+async def _probe_roots() -> None:
+    """
+    Measure every root server once with a cheap `. NS` query and reorder
+    _ROOT_ORDER fastest-first, persisting the result for later runs. Runs
+    in the background; lookups in flight keep whatever order they hold.
+    """
+    global _ROOT_ORDER
+    query = dns.message.make_query(dns.name.root, dns.rdatatype.NS,
+                                   use_edns=0, payload=EDNS_PAYLOAD)
+    await asyncio.gather(*(_send_query(query, ip) for ip in ROOT_SERVERS),
+                         return_exceptions=True)
+    _ROOT_ORDER = tuple(sorted(ROOT_SERVERS,
+                               key=lambda ip: RTT.get(ip, MAX_TIMEOUT)))
+    try:
+        os.makedirs(os.path.dirname(_ROOT_ORDER_FILE), exist_ok=True)
+        tmp_path = _ROOT_ORDER_FILE + ".tmp"
+        with open(tmp_path, "w") as order_file:
+            json.dump(_ROOT_ORDER, order_file)
+        os.replace(tmp_path, _ROOT_ORDER_FILE)
+    except OSError:
+        pass
+
+
+def _ensure_root_probe() -> None:
+    """
+    Arrange for the one-shot root probe on first resolver use: skipped
+    entirely when a fresh persisted ordering exists.
+    """
+    global _ROOT_PROBE_STARTED
+    if _ROOT_PROBE_STARTED:
+        return
+    _ROOT_PROBE_STARTED = True
+    if not _load_root_order():
+        asyncio.ensure_future(_probe_roots())
+
 
 def lookup(target_name: dns.name.Name,
            qtype: dns.rdata.Rdata) -> dns.message.Message:
     """
-    Recursive DNS resolver with caching, CNAME handling, unglued NS resolution,
-    and intermediate caching for efficiency.
+    Synchronous entry point for `_lookup`, kept for callers that are not
+    running an event loop of their own.
+    """
+    return asyncio.run(_lookup(target_name, qtype))
+
+
+# In-flight resolutions keyed like CACHE, so concurrent askers of the same
+# (name, qtype) share one root walk instead of racing duplicates. All
+# resolution funnels through one event loop — the sync lookup() and
+# collect_results() wrappers run their own loop per call — so this map
+# needs no locking and no thread-side (Event-based) counterpart.
+PENDING = {}
+
+# Keys with a background stale-entry refresh already under way.
+_REFRESHING = set()
+
+
+def _schedule_refresh(target_name: dns.name.Name, qtype) -> None:
+    """
+    Kick off a background re-resolution of a stale cache entry, at most one
+    per key at a time; _resolve overwrites the cache entry when it lands.
+    """
+    key = (target_name, qtype)
+    if key in PENDING or key in _REFRESHING:
+        return
+    _REFRESHING.add(key)
+    task = asyncio.ensure_future(_resolve(target_name, qtype))
+
+    def _done(finished, key=key):
+        _REFRESHING.discard(key)
+        if not finished.cancelled():
+            finished.exception()  # keep failed refreshes from warning
+
+    task.add_done_callback(_done)
+
+
+async def _lookup(target_name: dns.name.Name,
+                  qtype: dns.rdata.Rdata,
+                  depth: int = 0,
+                  visited: frozenset = frozenset()) -> dns.message.Message:
+    """
+    Cache-and-coalesce front for `_resolve`: serve from the cache when
+    possible, and when an identical query is already in flight await its
+    result rather than starting a second walk (the gathered CNAME/A/AAAA/MX
+    lookups would otherwise each re-resolve the same nameservers).
+
+    `depth` and `visited` carry the recursion budget and the (name, qtype)
+    keys already being resolved along this chain. Hitting either bound
+    returns an uncached empty answer — crucially *before* consulting
+    PENDING, since a cycle's repeat key would otherwise await its own
+    in-flight future and hang forever.
+
+    A just-expired entry inside the cache's grace window is served
+    immediately while a background task refreshes it, so popular names
+    never block on re-resolution at the moment their TTL lapses.
+    """
+    cached, fresh = CACHE.peek((target_name, qtype))
+    if cached is not None:
+        if not fresh:
+            _schedule_refresh(target_name, qtype)
+        return cached
+
+    key = (target_name, qtype)
+    if key in visited or depth > MAX_RECURSION_DEPTH:
+        return dns.message.make_response(
+            dns.message.make_query(target_name, qtype))
+
+    inflight = PENDING.get(key)
+    if inflight is not None:
+        if not visited:
+            return await inflight
+        # Mid-chain we must not block on another task's future: with cyclic
+        # zone data two concurrent chains can each own a key the other
+        # needs, and the mutual await would never resolve. Do the (rare)
+        # duplicate walk instead; the cycle guard above still bounds it.
+        return await _resolve(target_name, qtype, depth, visited | {key})
+
+    future = asyncio.get_running_loop().create_future()
+    PENDING[key] = future
+    try:
+        response = await _resolve(target_name, qtype, depth, visited | {key})
+    except BaseException as exc:
+        if not future.cancelled():
+            future.set_exception(exc)
+            future.exception()  # mark retrieved when nobody is waiting
+        raise
+    else:
+        future.set_result(response)
+        return response
+    finally:
+        PENDING.pop(key, None)
+
+
+def _collect_a_ips(response, seen_ips: set, next_ns_ips: list) -> None:
+    """
+    Append the IPv4 addresses found in `response`'s answer section to
+    next_ns_ips, deduplicating through seen_ips.
     """
-    global _LAST_NAMESERVERS
+    for rrset in getattr(response, "answer", []):
+        if rrset.rdtype == dns.rdatatype.A:
+            for rr in rrset:
+                ipv4 = rr.address
+                if ":" not in ipv4 and ipv4 not in seen_ips:
+                    seen_ips.add(ipv4)
+                    next_ns_ips.append(ipv4)
 
-    key = (str(target_name), qtype)
-    if key in CACHE:
-        return CACHE[key]
 
-    # --- NEW: Try to reuse cached NS records for parent zones ---
-    parent = target_name
-    while parent.labels:
+def _best_known_ns(name: dns.name.Name) -> list:
+    """
+    Walk from `name` toward the root and return the nameserver IPs of the
+    deepest zone cut we still hold cached NS (and address) records for —
+    the classic deepest-delegation start real resolvers use — or an empty
+    list when nothing useful is cached. A zone whose NS set is cached but
+    whose server addresses have expired is skipped in favor of a
+    shallower, still-addressable ancestor.
+    """
+    rdtype_a = dns.rdatatype.A
+    rdtype_ns = dns.rdatatype.NS
+    parent = name
+    while parent != dns.name.root:
         parent = parent.parent()
-        ns_key = (str(parent), dns.rdatatype.NS)
-        if ns_key in CACHE:
-            ns_resp = CACHE[ns_key]
-            next_ns_ips = []
-            for rrset in getattr(ns_resp, "authority", []):
-                if rrset.rdtype == dns.rdatatype.NS:
-                    for rr in rrset:
-                        ns_name = str(rr.target)
-                        a_key = (ns_name, dns.rdatatype.A)
-                        if a_key in CACHE:
-                            a_resp = CACHE[a_key]
-                            for aset in getattr(a_resp, "answer", []):
-                                if aset.rdtype == dns.rdatatype.A:
-                                    for rr2 in aset:
-                                        ipv4 = str(rr2)
-                                        if ":" not in ipv4 and ipv4 not in next_ns_ips:
-                                            next_ns_ips.append(ipv4)
-            if next_ns_ips:
-                _LAST_NAMESERVERS = list(next_ns_ips)
-                break
-    # --- END NEW BLOCK ---
+        ns_resp = cached_lookup(parent, rdtype_ns)
+        if ns_resp is None:
+            continue
+        ips = []
+        seen = set()
+        for rrset in getattr(ns_resp, "authority", []):
+            if rrset.rdtype == rdtype_ns:
+                for rr in rrset:
+                    a_resp = cached_lookup(rr.target, rdtype_a)
+                    if a_resp is not None:
+                        for aset in getattr(a_resp, "answer", []):
+                            if aset.rdtype == rdtype_a:
+                                for rr2 in aset:
+                                    ipv4 = rr2.address
+                                    if ":" not in ipv4 and ipv4 not in seen:
+                                        seen.add(ipv4)
+                                        ips.append(ipv4)
+        if ips:
+            return ips
+    return []
+
+
+async def _resolve(target_name: dns.name.Name,
+                   qtype: dns.rdata.Rdata,
+                   depth: int = 0,
+                   visited: frozenset = frozenset()) -> dns.message.Message:
+    """
+    Recursive DNS resolver with caching, CNAME handling, unglued NS resolution,
+    and intermediate caching for efficiency. Each referral level queries its
+    best few candidate servers in parallel and proceeds with the first reply.
+    """
+    _ensure_root_probe()
+    rdtype_a = dns.rdatatype.A
+    rdtype_ns = dns.rdatatype.NS
+
+    # A remembered authoritative NXDOMAIN for this name or any ancestor
+    # denies the whole subtree — answer empty without touching the network.
+    node = target_name
+    while True:
+        if cached_lookup(node, _NXDOMAIN) is not None:
+            denied = dns.message.make_response(
+                dns.message.make_query(target_name, qtype))
+            denied.set_rcode(dns.rcode.NXDOMAIN)
+            cache_store(target_name, qtype, denied, ttl=NEGATIVE_TTL)
+            return denied
+        if node == dns.name.root:
+            break
+        node = node.parent()
 
-    nameservers = list(_LAST_NAMESERVERS)
+    # Start from the deepest delegation we still have cached; with no
+    # usable hint, from the roots. The walk's server state lives entirely
+    # in locals — concurrent lookups can no longer disturb each other the
+    # way the old last-working-servers module global allowed.
+    hint_ips = _best_known_ns(target_name)
+    nameservers = tuple(hint_ips) if hint_ips else _ROOT_ORDER
     tried = set()
-    fail_count = 0
-    MAX_FAILS = 4
+    restarted = False
+
+    # One query message serves every server at every level; dnspython is
+    # happy to send the same message repeatedly, so there is no need to
+    # rebuild it (fresh ID, flags, wire encoding) per candidate.
+    query = dns.message.make_query(target_name, qtype, use_edns=0,
+                                   payload=EDNS_PAYLOAD, want_dnssec=False)
 
     while nameservers:
-        for ns in nameservers:
-            if ns in tried:
-                continue
-            tried.add(ns)
+        # Candidates are pre-filtered once per level: `tried` is scoped to
+        # this walk (so a referral looping back to an earlier level finds
+        # nothing left and terminates instead of rescanning it), while the
+        # penalty box only skips servers for as long as their box lasts —
+        # it never permanently poisons an IP for future walks.
+        now = time.monotonic()
+        level = [ns for ns in nameservers
+                 if ns not in tried and DEAD_NS.get(ns, 0) <= now]
+        if not level:
+            # Level exhausted (all failed, or a referral looped back);
+            # restart from the roots once before giving up.
+            if restarted:
+                break
+            restarted = True
+            nameservers = _ROOT_ORDER
+            continue
 
-            try:
-                query = dns.message.make_query(target_name, qtype)
-                response = dns.query.udp(query, ns, timeout=3)
-                fail_count = 0
-            except Exception:
-                fail_count += 1
-                if fail_count >= MAX_FAILS:
-                    _LAST_NAMESERVERS = list(ROOT_SERVERS)
-                    nameservers = list(ROOT_SERVERS)
-                    fail_count = 0
-                continue
+        # Probe the k healthiest-looking candidates together; unmeasured
+        # servers rank between fast and slow known ones. A failed batch
+        # falls through to the next k at the same level. The shuffle ahead
+        # of the (stable) sort rotates servers with equal estimates so the
+        # same IP doesn't soak up every query, and epsilon-greedy
+        # exploration swaps a random reserve candidate into the batch.
+        random.shuffle(level)
+        level.sort(key=lambda ip: RTT.get(ip, 0.5))
+        batch = level[:FANOUT]
+        if len(level) > FANOUT and random.random() < EXPLORE_CHANCE:
+            batch[-1] = random.choice(level[FANOUT:])
+        tried.update(batch)
 
-            # --- Case 1: Direct Answer ---
-            if response.answer:
-                _LAST_NAMESERVERS = [ns]
-                for rrset in response.answer:
-                    # --- Handle CNAME Restart ---
-                    if rrset.rdtype == dns.rdatatype.CNAME:
-                        cname_target = rrset[0].target
-                        cname_response = lookup(cname_target, qtype)
-                        a_response = lookup(cname_target, dns.rdatatype.A)
-                        aaaa_response = lookup(cname_target, dns.rdatatype.AAAA)
-
-                        merged = dns.message.make_response(query)
-                        merged.answer.extend(response.answer)
-                        merged.answer.extend(cname_response.answer)
-                        merged.answer.extend(a_response.answer)
-                        merged.answer.extend(aaaa_response.answer)
-
-                        CACHE[(str(target_name), dns.rdatatype.CNAME)] = response
-                        CACHE[key] = merged
-                        return merged
-
-                CACHE[key] = response
+        found = await _query_first(query, batch, timeout=3)
+        if found is None:
+            continue
+        ns, response = found
+
+        # --- Authoritative NXDOMAIN: remember the denial per RFC 2308 ---
+        # Only an authoritative denial (AA flag) carrying the zone's SOA is
+        # believed; its TTL is the smaller of the SOA record's own TTL and
+        # its MINIMUM field. A denial whose answer section holds a CNAME
+        # means the *chain target* is what doesn't exist — the alias itself
+        # does — so it must flow into the CNAME handling below instead.
+        if response.rcode() == dns.rcode.NXDOMAIN \
+                and not response.answer \
+                and response.flags & dns.flags.AA:
+            soa = next((rrset for rrset in response.authority
+                        if rrset.rdtype == dns.rdatatype.SOA), None)
+            if soa is not None:
+                neg_ttl = min(soa.ttl, soa[0].minimum) or NEGATIVE_TTL
+                cache_store(target_name, _NXDOMAIN, response, ttl=neg_ttl)
+                cache_store(target_name, qtype, response, ttl=neg_ttl)
                 return response
 
-            # --- Case 2: Referral (with or without glue) ---
-            next_ns_ips = []
-
-            # Collect glue (A records in additional)
-            for rrset in response.additional:
-                if rrset.rdtype == dns.rdatatype.A:
-                    for rr in rrset:
-                        ipv4 = str(rr)
-                        if ipv4 not in next_ns_ips:
-                            next_ns_ips.append(ipv4)
-                            CACHE[(str(rrset.name), dns.rdatatype.A)] = rr
-
-            # Collect NS names if no glue provided
-            ns_names = []
-            for rrset in response.authority:
-                if rrset.rdtype == dns.rdatatype.NS:
-                    for rr in rrset:
-                        ns_name = str(rr.target)
-                        if ns_name not in ns_names:
-                            ns_names.append(ns_name)
-                    # Cache delegation info (intermediate caching)
-                    CACHE[(str(rrset.name), dns.rdatatype.NS)] = response
-
-            # Resolve unglued NS to A records
-            if not next_ns_ips and ns_names:
-                for ns_name in ns_names:
-                    ns_key = (ns_name, dns.rdatatype.A)
-                    if ns_key in CACHE:
-                        ns_resp = CACHE[ns_key]
-                    else:
+        # --- Case 1: Direct Answer ---
+        if response.answer:
+            for rrset in response.answer:
+                # --- Handle CNAME Restart ---
+                if rrset.rdtype == dns.rdatatype.CNAME:
+                    # Follow the chain with ONE sub-lookup per hop, widened
+                    # to the independent A/AAAA pair only at the entry hop
+                    # (depth 0). Widening at every hop looks harmless but
+                    # spawns 3^k concurrent tasks on a k-hop chain, because
+                    # each gathered branch follows the remaining chain
+                    # itself — an adversarial 40-hop zone hung the resolver
+                    # that way. The gather still collapses the entry hop's
+                    # serial round-trips.
+                    cname_target = rrset[0].target
+                    follow_types = [qtype]
+                    if depth == 0:
+                        follow_types += [t for t in (dns.rdatatype.A,
+                                                     dns.rdatatype.AAAA)
+                                         if t != qtype]
+                    followups = await asyncio.gather(
+                        *(_lookup(cname_target, follow_type,
+                                  depth + 1, visited)
+                          for follow_type in follow_types))
+
+                    merged = dns.message.make_response(query)
+                    merged.answer.extend(response.answer)
+                    for followup in followups:
+                        merged.answer.extend(followup.answer)
+
+                    cache_store(target_name, dns.rdatatype.CNAME, response)
+                    cache_store(target_name, qtype, merged)
+                    return merged
+
+            cache_store(target_name, qtype, response)
+            return response
+
+        # --- Case 2: Referral (with or without glue) ---
+        # Ordered IP list with a set alongside: membership checks on the
+        # bare list go quadratic on glue-heavy TLD referrals.
+        next_ns_ips = []
+        seen_ips = set()
+
+        # Collect glue (A records in additional), caching each glue rrset
+        # as a small answer so later unglued referrals can reuse it.
+        for rrset in response.additional:
+            if rrset.rdtype == rdtype_a:
+                glue_resp = dns.message.make_response(
+                    dns.message.make_query(rrset.name, rdtype_a))
+                glue_resp.answer.append(rrset)
+                cache_store(rrset.name, rdtype_a, glue_resp,
+                            ttl=rrset.ttl)
+                for rr in rrset:
+                    ipv4 = rr.address
+                    if ipv4 not in seen_ips:
+                        seen_ips.add(ipv4)
+                        next_ns_ips.append(ipv4)
+
+        # Collect NS names if no glue provided. rr.target already is a
+        # Name object — keep it, rather than detouring through text and
+        # re-parsing it for the lookup and cache keys below.
+        ns_names = []
+        seen_ns = set()
+        for rrset in response.authority:
+            if rrset.rdtype == rdtype_ns:
+                for rr in rrset:
+                    if rr.target not in seen_ns:
+                        seen_ns.add(rr.target)
+                        ns_names.append(rr.target)
+                # Cache delegation info (intermediate caching)
+                cache_store(rrset.name, rdtype_ns, response,
+                            ttl=rrset.ttl)
+
+        # Resolve unglued NS to A records (itself a full walk, so its
+        # nesting is held to the tighter MAX_NS_DEPTH budget). Cached
+        # answers are harvested first; the rest resolve concurrently, and
+        # the first usable result lets the walk continue while the slower
+        # siblings are cancelled.
+        if not next_ns_ips and ns_names:
+            to_resolve = []
+            for ns_name_obj in ns_names:
+                ns_resp = cached_lookup(ns_name_obj, rdtype_a)
+                if ns_resp is not None:
+                    _collect_a_ips(ns_resp, seen_ips, next_ns_ips)
+                elif depth < MAX_NS_DEPTH:
+                    to_resolve.append(ns_name_obj)
+            if not next_ns_ips and to_resolve:
+                tasks = {asyncio.ensure_future(
+                            _lookup(ns_name_obj, rdtype_a,
+                                    depth + 1, visited)): ns_name_obj
+                         for ns_name_obj in to_resolve}
+                task_pending = set(tasks)
+                while task_pending and not next_ns_ips:
+                    task_done, task_pending = await asyncio.wait(
+                        task_pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in task_done:
                         try:
-                            ns_resp = lookup(dns.name.from_text(ns_name), dns.rdatatype.A)
-                            CACHE[ns_key] = ns_resp
+                            ns_resp = task.result()
                         except Exception:
                             continue
+                        cache_store(tasks[task], rdtype_a, ns_resp)
+                        _collect_a_ips(ns_resp, seen_ips, next_ns_ips)
+                for task in task_pending:
+                    task.cancel()
+                if task_pending:
+                    await asyncio.gather(*task_pending,
+                                         return_exceptions=True)
 
-                    for rrset in getattr(ns_resp, "answer", []):
-                        if rrset.rdtype == dns.rdatatype.A:
-                            for rr in rrset:
-                                ipv4 = str(rr)
-                                if ":" not in ipv4 and ipv4 not in next_ns_ips:
-                                    next_ns_ips.append(ipv4)
-
-            # If no next NS IPs found, restart from roots
-            if not next_ns_ips:
-                _LAST_NAMESERVERS = list(ROOT_SERVERS)
-                nameservers = list(ROOT_SERVERS)
+        # If no next NS IPs found, restart from roots
+        if not next_ns_ips:
+            if restarted:
                 break
+            restarted = True
+            nameservers = _ROOT_ORDER
+            continue
 
-            # Cache intermediate glue results
-            for rrset in response.additional:
-                if rrset.rdtype == dns.rdatatype.A:
-                    for rr in rrset:
-                        CACHE[(str(rrset.name), dns.rdatatype.A)] = rr
-
-            # Continue recursion to next layer
-            _LAST_NAMESERVERS = list(next_ns_ips)
-            nameservers = next_ns_ips
-            break
-        else:
-            break
+        # Continue recursion to next layer
+        nameservers = tuple(next_ns_ips)
 
     # --- Fallback Empty Response ---
-    empty = dns.message.make_response(dns.message.make_query(target_name, qtype))
-    CACHE[key] = empty
+    empty = dns.message.make_response(query)
+    cache_store(target_name, qtype, empty, ttl=NEGATIVE_TTL)
     return empty
 
 
-
-
 def print_results(results: dict) -> None:
     """
     take the results of a `lookup` and print them to the screen like the host
     program would.
     """
 
-    for rtype, fmt_str in FORMATS:
-        for result in results.get(rtype, []):
-            print(fmt_str.format(**result))
+    for rtype, fmt in FORMATS:
+        for result in results.get(rtype, ()):
+            print(fmt(result))
+
+
+async def _collect_all(names) -> list:
+    """
+    Resolve several names concurrently, preserving the input order of the
+    results so the printed output stays deterministic.
+    """
+    return await asyncio.gather(*(_collect_results(name) for name in names))
 
 
 def main():
@@ -264,8 +1112,10 @@ def main():
                                  help="increase output verbosity",
                                  action="store_true")
     program_args = argument_parser.parse_args()
-    for a_domain_name in program_args.name:
-        print_results(collect_results(a_domain_name))
+    _load_cache()
+    atexit.register(_persist_cache)
+    for results in asyncio.run(_collect_all(program_args.name)):
+        print_results(results)
 
 if __name__ == "__main__":
     main()